@@ -35,12 +35,16 @@ def test(load_current: float, cell_count: int, stop_voltage: float, make: str, s
                     kun.set_cc_A(load_current)
 
                     # Monitor for too big sag
+                    deadline = time.monotonic()
                     for _ in range(loading_time_s):
-                        logger.info(f"Cell voltage {monitor.voltage / cell_count} V ({monitor.voltage=} V > {actual_stop_voltage=} V)")
-                        if monitor.voltage < actual_stop_voltage:
+                        voltage = monitor.voltage
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info(f"Cell voltage {voltage / cell_count} V ({voltage=} V > {actual_stop_voltage=} V)")
+                        if voltage < actual_stop_voltage:
                             test_stop = True
                             break
-                        time.sleep(1.0)
+                        deadline += 1.0
+                        time.sleep(max(0.0, deadline - time.monotonic()))
                     if test_stop:
                         break
             except KeyboardInterrupt:
@@ -1,66 +1,157 @@
-import re
 import logging
 import pathlib
-from typing import List
+import concurrent.futures
+from typing import List, Tuple
 
 import scipy
 import pandas
 import numpy
 import matplotlib.pyplot as plt
 
-logger = logging.getLogger(__name__)
+try:
+    import numba
+except ImportError:
+    numba = None
 
+logger = logging.getLogger(__name__)
 
-def process_file(csv_file: pathlib.Path, color: str, axs: List[plt.Axes]):
-    match = re.match(
-        r"(?P<make>\w+)_(?P<ah>\d+)ah_(?P<t_relax>\d+)s_(?P<t_load>\d+)s_(?P<A>\d+)A_.*",
-        csv_file.name)
-    make = match.group("make")
-    capacity = float(match.group("ah"))
-    load_current = int(match.group("A"))
+# Set to "pyarrow" for faster CSV parsing (pyarrow is required anyway for the Parquet cache)
+CSV_ENGINE = "c"
+# Bump when clean_file() output changes (cleaning code, CSV_DTYPES) to invalidate cached frames
+CLEAN_CACHE_VERSION = 2
+# float32 resolves ~4 uV at 40 V, plenty for mV scale voltage drops
+CSV_DTYPES = {
+    "Sense": "category",
+    "Mode": "category",
+    "Voltage": "float32",
+    "Current": "float32",
+    "Setpoint": "float32",
+    "Slope Up": "float32",
+    "Slope Down": "float32",
+    "Battery Display Unit": "category",
+    "Battery Buzz Mode": "category",
+    "AH": "float32",
+    "WH": "float32",
+}
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def binary_erosion_1d(mask: numpy.ndarray, iterations: int) -> numpy.ndarray:
+        """scipy.ndimage.binary_erosion equivalent for 1D masks (structure [1, 1, 1])."""
+        out = mask.copy()
+        n = out.size
+        for _ in range(iterations):
+            prev = False
+            for i in range(n):
+                cur = out[i]
+                nxt = out[i + 1] if i + 1 < n else False
+                out[i] = prev and cur and nxt
+                prev = cur
+        return out
+
+    binary_erosion_1d(numpy.ones(3, dtype=numpy.bool_), 1)  # Warm up JIT
+else:
+    def binary_erosion_1d(mask: numpy.ndarray, iterations: int) -> numpy.ndarray:
+        return scipy.ndimage.binary_erosion(input=mask, iterations=iterations)
+
+
+def _interp_fill(values: numpy.ndarray) -> numpy.ndarray:
+    """Linear fill between known values, leading NaNs kept as pandas interpolate() does."""
+    index = numpy.arange(values.size)
+    known = ~numpy.isnan(values)
+    if not known.any():
+        return values
+    filled = numpy.interp(index, index[known], values[known])
+    filled[:numpy.argmax(known)] = numpy.nan
+    return filled
+
+
+def clean_file(csv_file: pathlib.Path) -> pandas.DataFrame:
+    # <make>_<ah>ah_<t_relax>s_<t_load>s_<A>A_<serno>...
+    parts = csv_file.stem.split("_")
+    make = parts[0]
+    capacity = float(parts[1][:-len("ah")])
+    load_current = int(parts[4][:-len("A")])
     logging.info(f"Parsed {make} battery {capacity:.1f} Ah with {load_current} A load current.")
     df = pandas.read_csv(
         csv_file,
         delimiter=",",
-        parse_dates=[0],
-        index_col=0
+        engine=CSV_ENGINE,
+        dtype=CSV_DTYPES
     )
+    # Index by first column, older logs have no Timestamp column.
+    # Done after read_csv as pyarrow engine fails with index_col and dtype combined.
+    index_column = df.columns[0]
+    if index_column == "Timestamp":
+        df[index_column] = pandas.to_datetime(df[index_column])
+    df = df.set_index(index_column)
     df["Cell Voltage"] = df["Voltage"] / 5
     df["Loaded"] = df["Current"] > (0.99 * load_current)
     df["Relaxed"] = df["Current"] < 0.1
 
     # Remove sloping current (Load transition cleaning 1)
-    smaller_than = df["Current"] < 0.1
-    larger_than = df["Current"] > (0.99 * load_current)
-    valid_values = smaller_than | larger_than
-    df = df[valid_values]
-    logger.info(f"Removed {sum(~valid_values)} transition samples")
+    current = df["Current"].to_numpy()
+    valid_values = (current < 0.1) | (current > (0.99 * load_current))
+    df = df.iloc[valid_values]
+    logger.info(f"Removed {numpy.count_nonzero(~valid_values)} transition samples")
 
     # Erode close by samples (Load transition cleaning 2)
-    mask = scipy.ndimage.binary_erosion(
-        input=df["Current"].diff().abs() < (0.9 * load_current),
-        iterations=2
-    )
-    df = df[mask]
-    logger.info(f"Eroded {sum(~mask)} transition samples")
+    current = current[valid_values]
+    current_step = numpy.empty_like(current)
+    current_step[0:1] = numpy.nan
+    numpy.subtract(current[1:], current[:-1], out=current_step[1:])
+    mask = binary_erosion_1d(
+        numpy.abs(current_step, out=current_step) < (0.9 * load_current), iterations=2)
+    df = df.iloc[mask]
+    logger.info(f"Eroded {numpy.count_nonzero(~mask)} transition samples")
 
     # Fill NaN values between resting/loading phases
-    df["Loaded Battery Voltage"] = numpy.nan
-    df.loc[df["Loaded"], "Loaded Battery Voltage"] = \
-        df.loc[df["Loaded"], "Voltage"]
-    df["Relaxed Battery Voltage"] = numpy.nan
-    df.loc[df["Relaxed"], "Relaxed Battery Voltage"] = \
-        df.loc[df["Relaxed"], "Voltage"]
-    df["Loaded Battery Voltage"] = df["Loaded Battery Voltage"].interpolate()
-    df["Relaxed Battery Voltage"] = df["Relaxed Battery Voltage"].interpolate()
+    df["Loaded Battery Voltage"] = _interp_fill(
+        numpy.where(df["Loaded"], df["Voltage"], numpy.nan))
+    df["Relaxed Battery Voltage"] = _interp_fill(
+        numpy.where(df["Relaxed"], df["Voltage"], numpy.nan))
 
     # Calculate Voltage drop and resistance
     df["Battery Voltage Drop"] = df["Relaxed Battery Voltage"] - df["Loaded Battery Voltage"]
     df["Battery Resistance mOhm"] = (df["Battery Voltage Drop"] / load_current) * 1e3
+    return df
+
+
+def load_file(csv_file: pathlib.Path) -> pandas.DataFrame:
+    # Cleaned frame is cached next to the log, refreshed when the log is newer
+    cache = csv_file.with_suffix(f".clean-v{CLEAN_CACHE_VERSION}.parquet")
+    if cache.exists() and cache.stat().st_mtime >= csv_file.stat().st_mtime:
+        logger.info(f"Using cached {cache}")
+        return pandas.read_parquet(cache)
+
+    # Write via temporary file so an interrupted write never leaves a truncated cache
+    df = clean_file(csv_file)
+    cache_tmp = cache.with_name(f"{cache.name}.tmp")
+    try:
+        df.to_parquet(cache_tmp)
+        cache_tmp.replace(cache)
+    finally:
+        cache_tmp.unlink(missing_ok=True)
+    return df
+
+
+def process_file(csv_file: pathlib.Path) -> Tuple[numpy.ndarray, ...]:
+    # Runs in a worker process, keep matplotlib out of here
+    df = load_file(csv_file)
+    return (
+        df["AH"].to_numpy(),
+        df["Relaxed Battery Voltage"].to_numpy(),
+        df["Loaded Battery Voltage"].to_numpy(),
+        df["Battery Resistance mOhm"].to_numpy()
+    )
+
 
-    df.plot(ax=axs[0], x="AH", y=["Relaxed Battery Voltage", "Loaded Battery Voltage"],
-            color=color, legend=False)
-    df.plot(ax=axs[1], x="AH", y="Battery Resistance mOhm", color=color, legend=False)
+def plot_file(traces: Tuple[numpy.ndarray, ...], color: str, axs: List[plt.Axes]):
+    ah, relaxed, loaded, resistance = traces
+    axs[0].plot(ah, relaxed, color=color)
+    axs[0].plot(ah, loaded, color=color)
+    axs[1].plot(ah, resistance, color=color)
 
 
 def process_files(csv_files: List[pathlib.Path], plt_name: pathlib.Path):
@@ -73,10 +164,14 @@ def process_files(csv_files: List[pathlib.Path], plt_name: pathlib.Path):
     axs[0].set_ylabel("Voltage [V]")
     axs[1].set_ylabel("Resistance [mΩ]")
 
-    # Process files
-    for color, csv_file in zip(colors_available, csv_files):
+    # Process files in parallel (one per available color), plot in main process
+    csv_files = csv_files[:len(colors_available)]
+    for csv_file in csv_files:
         logging.info(f"Analyzing {csv_file}")
-        process_file(csv_file, color, axs)
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = list(executor.map(process_file, csv_files))
+    for color, traces in zip(colors_available, results):
+        plot_file(traces, color, axs)
 
     axs[0].legend(
         (plt.Line2D([0], [0], color=color, lw=1) for color in colors_available),
@@ -84,6 +179,7 @@ def process_files(csv_files: List[pathlib.Path], plt_name: pathlib.Path):
     )
 
     # Post adjust
+    axs[-1].set_xlabel("AH")
     for ax in axs:
         #ax.set_xlim([0, 5])
         ax.grid(True)
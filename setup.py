@@ -23,4 +23,7 @@ setup(
         "pyserial ~= 3.5",
         "tenacity ~= 8.2"
     ],
+    extras_require={
+        "fast": ["crcmod ~= 1.7"]
+    },
 )
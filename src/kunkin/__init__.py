@@ -1,16 +1,87 @@
-import csv
 import time
 import datetime
 import logging
 import pathlib
+import struct
 import threading
-from typing import Optional
+from typing import Dict, Optional
 
 from tenacity import retry, retry_if_exception_type, stop_after_attempt
 import serial
 
+try:
+    import crcmod.predefined
+except ImportError:
+    crcmod = None
+
 logger = logging.getLogger(__name__)
 
+
+def _crc16_modbus_table() -> tuple:
+    table = []
+    for seed in range(256):
+        result = seed
+        for i in range(8):
+            even = result & 1
+            result >>= 1
+            result ^= 0xA001 if even else 0
+        table.append(result)
+    return tuple(table)
+
+
+CRC16_MODBUS_TABLE = _crc16_modbus_table()
+
+
+def _crc16_modbus_py(byts) -> int:
+    result = 0xFFFF
+    table = CRC16_MODBUS_TABLE
+    for byt in byts:
+        result = (result >> 8) ^ table[(result ^ byt) & 0xFF]
+    return result
+
+
+# Prefer crcmod (C extension) when installed, fall back to the table version
+if crcmod is not None:
+    _crc16_modbus = crcmod.predefined.mkPredefinedCrcFun("modbus")
+else:
+    _crc16_modbus = _crc16_modbus_py
+
+
+_READ_STRUCT = struct.Struct(">BBHH")  # Device, Read op, Address, Read length
+_WRITE_STRUCT = struct.Struct(">BBHHBI")  # Device, Write op, Address, Something, Length, Value
+_CRC_STRUCT = struct.Struct("<H")
+_READ_FRAME_SIZE = _READ_STRUCT.size + _CRC_STRUCT.size
+_WRITE_FRAME_SIZE = _WRITE_STRUCT.size + _CRC_STRUCT.size
+
+
+def _pack_crc(frame: bytearray) -> None:
+    # Checksum over everything but the trailing CRC field
+    size = len(frame) - _CRC_STRUCT.size
+    _CRC_STRUCT.pack_into(frame, size, _crc16_modbus(bytes(memoryview(frame)[:size])))
+
+
+def _status_block_frame(address: int) -> bytes:
+    msg = bytearray(_READ_FRAME_SIZE)
+    _READ_STRUCT.pack_into(msg, 0, 0x01, 0x03, address, 0x0000)  # Special length for status blocks
+    _pack_crc(msg)
+    return bytes(msg)
+
+
+# _STATUS_ADDRESS = 0x300  # Short statusblock read address
+_STATUS_ADDRESS = 0x301  # Long statusblock read address
+_STATUS_FRAME = _status_block_frame(_STATUS_ADDRESS)
+
+# Long statusblock response layout, bytes 0..34 (checksum excluded)
+_STATUS_STRUCT = struct.Struct(
+    ">3x"    # Device + Read op + Length
+    "BB"     # Flags, Battery flags
+    "3s3s3s" # Voltage, Current, Setpoint
+    "HH"     # Slope Up, Slope Down
+    "3x"     # Unknown
+    "BBB"    # Battery Half Current, Display Unit, Buzz Mode
+    "3x"     # Unknown
+    "II")    # AH, WH
+
 class ChecksumError(Exception):
     pass
 
@@ -18,45 +89,75 @@ class Kp184:
     MODELS = {1840: "KP184"}
     MODES = ["CV", "CC", "CR", "CW"]
     BUZZ_MODES = ["ONE", "LAST", "LEVEL"]
+    RESPONSE_TIMEOUT_S = 1.2
 
-    def __init__(self, port: str):
+    def __init__(self, port: str, baudrate: int = 9600):
         self.port = port
+        self.baudrate = baudrate  # Must match the device setting, 19200 halves line time
         self.serial = None
         self.serial_lock = threading.Lock()
+        self._read_frame_cache: Dict[int, bytes] = {}
 
-        self.get_model = lambda: self.MODELS[self._modbus_read(0x1)]
+    def get_model(self) -> str:
+        return self.MODELS[self._modbus_read(0x1)]
 
-        self.set_output_on = lambda v: self._modbus_write(0x010e, int(v))  # True / False
-        self.is_output_on = lambda: self._modbus_read(0x010e) == 1
+    def set_output_on(self, v: bool) -> None:  # True / False
+        self._modbus_write(0x010e, int(v))
 
-        self.set_mode = lambda v: self._modbus_write(0x0110, self.MODES.index(v))
-        self.get_mode = lambda: self.MODES[self._modbus_read(0x0110)]
+    def is_output_on(self) -> bool:
+        return self._modbus_read(0x010e) == 1
 
-        self.set_cv_V = lambda v: self._modbus_write(0x0112, int(v * 1e3))
-        self.get_cv_V = lambda: self._modbus_read(0x0112) / 1e3
+    def set_mode(self, v: str) -> None:
+        self._modbus_write(0x0110, self.MODES.index(v))
 
-        self.set_cc_A = lambda v: self._modbus_write(0x0116, int(v * 1e3))
-        self.get_cc_A = lambda: self._modbus_read(0x0116) / 1e3
+    def get_mode(self) -> str:
+        return self.MODES[self._modbus_read(0x0110)]
 
-        self.set_cr_ohm = lambda v: self._modbus_write(0x011A, int(v))
-        self.get_cr_ohm = lambda: self._modbus_read(0x011A)
+    def set_cv_V(self, v: float) -> None:
+        self._modbus_write(0x0112, int(v * 1e3))
 
-        self.set_cw_W = lambda v: self._modbus_write(0x011E, int(v * 1e1))
-        self.get_cw_W = lambda: self._modbus_read(0x011E) / 1e1
+    def get_cv_V(self) -> float:
+        return self._modbus_read(0x0112) / 1e3
 
-        self.measure_voltage = lambda: self._modbus_read(0x0122) / 1e3
-        self.measure_current = lambda: self._modbus_read(0x0126) / 1e3
+    def set_cc_A(self, v: float) -> None:
+        self._modbus_write(0x0116, int(v * 1e3))
 
-        self.set_battery_stop = lambda v: self._modbus_write(0x146, int(v * 1e3))
-        self.get_battery_stop = lambda: self._modbus_read(0x146) / 1e3
+    def get_cc_A(self) -> float:
+        return self._modbus_read(0x0116) / 1e3
 
-        self.clear_ah = lambda: self._modbus_write(0x148, 0)
-        self.clear_wh = self.clear_ah
+    def set_cr_ohm(self, v: int) -> None:
+        self._modbus_write(0x011A, int(v))
+
+    def get_cr_ohm(self) -> int:
+        return self._modbus_read(0x011A)
+
+    def set_cw_W(self, v: float) -> None:
+        self._modbus_write(0x011E, int(v * 1e1))
+
+    def get_cw_W(self) -> float:
+        return self._modbus_read(0x011E) / 1e1
+
+    def measure_voltage(self) -> float:
+        return self._modbus_read(0x0122) / 1e3
+
+    def measure_current(self) -> float:
+        return self._modbus_read(0x0126) / 1e3
+
+    def set_battery_stop(self, v: float) -> None:
+        self._modbus_write(0x146, int(v * 1e3))
+
+    def get_battery_stop(self) -> float:
+        return self._modbus_read(0x146) / 1e3
+
+    def clear_ah(self) -> None:
+        self._modbus_write(0x148, 0)
+
+    clear_wh = clear_ah
 
     def __enter__(self):
         self.serial = serial.Serial(
-            port=self.port, baudrate=9600,
-            parity="N", stopbits=1, timeout=1.2)
+            port=self.port, baudrate=self.baudrate,
+            parity="N", stopbits=1, timeout=0.1, inter_byte_timeout=0.02)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -68,14 +169,15 @@ class Kp184:
 
     @staticmethod
     def _crc(byts) -> bytes:
-        result = 0xFFFF
-        for byt in byts:
-            result ^= byt
-            for i in range(8):
-                even = result & 1
-                result >>= 1
-                result ^= 0xA001 if even else 0
-        return result.to_bytes(length=2, byteorder="little")
+        return _CRC_STRUCT.pack(_crc16_modbus(byts))
+
+    def _read_exact(self, size: int) -> bytes:
+        # Short serial timeout, keep reading until frame is complete or deadline passes
+        deadline = time.monotonic() + self.RESPONSE_TIMEOUT_S
+        response = self.serial.read(size)
+        while len(response) < size and time.monotonic() < deadline:
+            response += self.serial.read(size - len(response))
+        return response
 
     def _raise_checksum(self, response) -> None:
         received = response[-2:]
@@ -92,62 +194,62 @@ class Kp184:
             return self.get_status_block_unsafe(*args, **kwargs)
 
     def get_status_block_unsafe(self) -> dict:
-        # address = 0x300  # Short statusblock read address
-        address = 0x301  # Long statusblock read address
-
-        # Build command
-        msg = b"\x01\x03"  # Device + Read op
-        msg += address.to_bytes(length=2, byteorder="big")
-        msg += b"\x00\x00" # Special length for status blocks
-        msg += self._crc(msg)
+        address = _STATUS_ADDRESS
+        msg = _STATUS_FRAME  # Constant command
 
         # Send command
         logger.debug(f"Read request *0x{address:04x} -> {msg.hex()}")
+        self.serial.reset_input_buffer()
         self.serial.write(msg)
 
         # Read response
-        response = self.serial.read(23 + 14)
+        response = self._read_exact(23 + 14)
         logger.debug(f"Response <- {response.hex()}")
         self._raise_checksum(response)
 
         # Extract payload
+        (flags, battery_flags, voltage, current, setpoint, slope_up, slope_down,
+         half_current, display_unit, buzz_mode, ah, wh) = _STATUS_STRUCT.unpack_from(response)
         result = {
-            "Output ON": f"{response[3]:08b}"[::-1][0] == '1',
-            "Sense": "Remote" if response[3] & 0x8 else "Local",
-            "Mode": self.MODES[int(f"{response[3]:08b}"[::-1][1:3], 2) - 1],
-            "Battery": bool(response[4] & 0x4),
-            #"Dyn": True if response[4] & 0x8 else False, TODO: Need testing
-            #"Cop": True if response[4] & 0x32 else False, TODO: Need testing
-            #"Oct": True if response[4] & 0x64 else False, TODO: Need testing
-            "Voltage": int.from_bytes(response[5:8], byteorder="big") / 1e3,
-            "Current": int.from_bytes(response[8:11], byteorder="big") / 1e3,
-            "Setpoint": int.from_bytes(response[11:14], byteorder="big") / 1e3,  # TODO: Need testing
-            "Slope Up": int.from_bytes(response[14:16], byteorder="big") / 10,
-            "Slope Down": int.from_bytes(response[16:18], byteorder="big") / 10,
-            # "Unknown": response[18:21],
-            "Battery Half Current": bool(response[21] & 0x1),
-            "Battery Display Unit": "WH" if response[22] & 0x1 else "AH",
-            "Battery Buzz Mode": self.BUZZ_MODES[response[23]],
-            "AH": int.from_bytes(response[27:31], byteorder="big") / 60 / 60 / 1e3,
-            "WH": int.from_bytes(response[31:35], byteorder="big") / 60 / 60 / 1e3
+            "Output ON": bool(flags & 0x1),
+            "Sense": "Remote" if flags & 0x8 else "Local",
+            "Mode": self.MODES[(((flags >> 1) & 0x1) << 1 | ((flags >> 2) & 0x1)) - 1],
+            "Battery": bool(battery_flags & 0x4),
+            #"Dyn": True if battery_flags & 0x8 else False, TODO: Need testing
+            #"Cop": True if battery_flags & 0x32 else False, TODO: Need testing
+            #"Oct": True if battery_flags & 0x64 else False, TODO: Need testing
+            "Voltage": int.from_bytes(voltage, byteorder="big") / 1e3,
+            "Current": int.from_bytes(current, byteorder="big") / 1e3,
+            "Setpoint": int.from_bytes(setpoint, byteorder="big") / 1e3,  # TODO: Need testing
+            "Slope Up": slope_up / 10,
+            "Slope Down": slope_down / 10,
+            "Battery Half Current": bool(half_current & 0x1),
+            "Battery Display Unit": "WH" if display_unit & 0x1 else "AH",
+            "Battery Buzz Mode": self.BUZZ_MODES[buzz_mode],
+            "AH": ah / 60 / 60 / 1e3,
+            "WH": wh / 60 / 60 / 1e3
         }
         return result
 
     def _modbus_read_unsafe(self, address: int) -> int:
-        # Build command
-        msg = b"\x01\x03"  # Device + Read op
-        msg += address.to_bytes(length=2, byteorder="big")
-        msg += b"\x00\x04"  # Read length
-        msg += self._crc(msg)
+        # Build command (cached per address)
+        msg = self._read_frame_cache.get(address)
+        if msg is None:
+            buf = bytearray(_READ_FRAME_SIZE)
+            _READ_STRUCT.pack_into(buf, 0, 0x01, 0x03, address, 0x0004)
+            _pack_crc(buf)
+            msg = bytes(buf)
+            self._read_frame_cache[address] = msg
         # msg_hex = msg.hex()
 
         # Send command
         logger.debug(f"Read request *0x{address:04x} -> {msg.hex()}")
+        self.serial.reset_input_buffer()
         self.serial.write(msg)
 
         # Read response
         tstart = time.time()
-        response = self.serial.read(9)
+        response = self._read_exact(9)
         response_time = time.time() - tstart
         # response_hex = response.hex()
         logger.debug(f"Response <- {response.hex()} ({response_time=:.3f})")
@@ -168,18 +270,17 @@ class Kp184:
 
     def _modbus_write_unsafe(self, address: int, value: int) -> None:
         # Build command
-        msg = b"\x01\x06"  # Device + Write op
-        msg += address.to_bytes(length=2, byteorder="big")
-        msg += b"\x00\x01\x04"  # Something + Write payload length
-        msg += value.to_bytes(length=4, byteorder="big")
-        msg += self._crc(msg)
+        msg = bytearray(_WRITE_FRAME_SIZE)
+        _WRITE_STRUCT.pack_into(msg, 0, 0x01, 0x06, address, 0x0001, 0x04, value)
+        _pack_crc(msg)
 
         # Send command
         logger.debug(f"Writing *0x{address:04x}=0x{value:02x} -> {msg.hex()}")
+        self.serial.reset_input_buffer()
         self.serial.write(msg)
 
         # Readback command (not sure of the exact format)
-        readback = self.serial.read(8)
+        readback = self._read_exact(8)
         self._raise_checksum(readback)
 
         readback_addr = int.from_bytes(readback[2:4], byteorder="big")
@@ -191,49 +292,80 @@ class Kp184:
             raise ChecksumError
 
 class BackgroundMonitor:
+    LOG_FLUSH_ROWS = 20
+    LOG_FLUSH_INTERVAL_S = 1.0
+    LOG_LINE_TERMINATOR = "\r\n"  # Same as csv.writer
+
     def __init__(self, device: Kp184, interval_s: float, log_file: Optional[pathlib.Path] = None):
         self.interval_s = interval_s
         self.time_next = None
         self.log_file = log_file
         self.device = device
-        self.alive = False
+        self._stop = threading.Event()
         self.index = None
         self.timestamp = None
         self.voltage = None
         self.current = None
         self.tz = datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
+
+        # Preformatted ISO 8601 offset, e.g. "+03:00"
+        utc_offset = self.tz.utcoffset(None)
+        self._utc_offset_s = utc_offset.total_seconds()
+        offset_min = int(self._utc_offset_s // 60)
+        self._tz_suffix = f"{'-' if offset_min < 0 else '+'}{abs(offset_min) // 60:02d}:{abs(offset_min) % 60:02d}"
         self.worker_thread = None
         self.worker_start = None
-        self.log = None
-
-    def _interwaller(self):
+        self.log_fid = None
+        self.log_template = None
+        self._pending = []
+        self._last_flush = None
+
+    def _flush_log(self):
+        self.log_fid.write("".join(self._pending))
+        self._pending.clear()
+        self.log_fid.flush()
+        self._last_flush = time.monotonic()
+
+    @property
+    def alive(self) -> bool:
+        return self.worker_thread is not None and not self._stop.is_set()
+
+    def _interwaller(self) -> bool:
+        """Wait until next sample, returns True if monitor was stopped meanwhile."""
         self.index += 1
         next_sample_time = self.worker_start + self.index * self.interval_s
-        sleep_to_next = next_sample_time - time.time()
+        sleep_to_next = next_sample_time - time.monotonic()
         if sleep_to_next < 0.0:
             logger.warning(f"BackgroundTracer cannot keep up with {self.interval_s=} ({sleep_to_next=} s)")
-        else:
-            logger.debug(f"Sleeping {sleep_to_next}")
-            time.sleep(sleep_to_next)
+            return self._stop.is_set()
+        logger.debug(f"Sleeping {sleep_to_next}")
+        return self._stop.wait(timeout=sleep_to_next)
 
     @retry(retry=retry_if_exception_type(ChecksumError), stop=stop_after_attempt(10))
     def _refresh(self):
         self.status_block = self.device.get_status_block()
 
-        self.timestamp = datetime.datetime.now(tz=self.tz).isoformat()
+        now = time.time()
+        self.timestamp = (
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now + self._utc_offset_s)) +
+            f".{int(now % 1 * 1e6):06d}{self._tz_suffix}")
 
         self.voltage = self.status_block["Voltage"]
         self.current = self.status_block["Current"]
 
     def _worker(self):
-        while self.alive:
+        while not self._stop.is_set():
             self._refresh()
 
-            if self.log is not None:
-                self.log.writerow(
-                    [self.timestamp] + list(self.status_block.values()))
+            if self.log_fid is not None:
+                self._pending.append(
+                    self.log_template.format(self.timestamp, *self.status_block.values()))
+                if (len(self._pending) >= self.LOG_FLUSH_ROWS or
+                        time.monotonic() - self._last_flush > self.LOG_FLUSH_INTERVAL_S):
+                    self._flush_log()
 
-            self._interwaller()
+            if self._interwaller():
+                break
 
     def __enter__(self):
         # Read once to get headers
@@ -242,23 +374,31 @@ class BackgroundMonitor:
         # Prepare optional log file
         if self.log_file is not None:
             file_existed = self.log_file.exists()
-            fid = self.log_file.open("a", newline="")
+            self.log_fid = self.log_file.open("a", newline="", buffering=1 << 16)
 
-            self.log = csv.writer(fid)
+            # Status block fields are numbers, bools and short enums, no CSV quoting needed
+            columns = ["Timestamp"] + list(self.status_block.keys())
+            self.log_template = ",".join("{}" for _ in columns) + self.LOG_LINE_TERMINATOR
 
             # Write headers
             if not file_existed:
-                self.log.writerow(["Timestamp"] + list(self.status_block.keys()))
+                self.log_fid.write(",".join(columns) + self.LOG_LINE_TERMINATOR)
+            self._last_flush = time.monotonic()
 
         # Start monitor thread
         self.index = 0
-        self.alive = True
+        self._stop.clear()
         self.worker_thread = threading.Thread(target=self._worker)
         self._refresh()
-        self.worker_start = time.time()
+        self.worker_start = time.monotonic()
         self.worker_thread.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.alive = False
+        self._stop.set()
         self.worker_thread.join()
+
+        # Write remaining rows
+        if self.log_fid is not None:
+            self._flush_log()
+            self.log_fid.close()